@@ -1,4 +1,4 @@
-#!/bin/env python2.7
+#!/bin/env python
 # encoding: utf-8
 # from __future__ import print_function
 from __future__ import division
@@ -6,89 +6,260 @@ from __future__ import division
 import os
 import sys
 from collections import defaultdict
-from collections import Iterable
 from collections import namedtuple
+from collections import OrderedDict
+from array import array
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import logging
 log = logging.getLogger(os.path.basename(__file__))
 # log.disabled = True
 
+Node = namedtuple('Node', ['taxid', 'rank', 'name'])
+
+# the dmp files are parsed as bytes, names and ranks are returned as str
+if sys.version_info[0] < 3:
+    def _decode(string):
+        return string
+else:
+    def _decode(string):
+        return string.decode('utf-8')
+
+
+class _LRUCache(object):
+    """ Mapping keeping only the maxsize most recently used items
+        (functools.lru_cache does not exist in python 2.7).
+
+        >>> cache = _LRUCache(maxsize=2)
+        >>> cache.put(1, 'a'); cache.put(2, 'b')
+        >>> cache.get(1)
+        'a'
+        >>> cache.put(3, 'c')
+        >>> cache.get(2) is None
+        True
+        >>> cache.get(1), cache.get(3)
+        ('a', 'c')
+    """
 
-def flatten(seq):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return None
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+def _children_csr(parent):
+    """ Builds the CSR children arrays (indptr, indices) of the tree given by
+        the parent index array (-1 for the root) : count the children of each
+        node, cumulative sum for the row pointers, then scatter the children
+        in index order.
+
+        >>> indptr, indices = _children_csr(array('i', [-1, 0, 1, 0]))
+        >>> list(indptr), list(indices)
+        ([0, 2, 3, 3, 3], [1, 3, 2])
+    """
+    n = len(parent)
+    indptr = array('i', [0]) * (n + 1)
+    for p in parent:
+        if p >= 0:
+            indptr[p + 1] += 1
+    for i in range(n):
+        indptr[i + 1] += indptr[i]
+    indices = array('i', [0]) * indptr[n]
+    fill = indptr[:-1]
+    for i, p in enumerate(parent):
+        if p >= 0:
+            indices[fill[p]] = i
+            fill[p] += 1
+    return indptr, indices
+
+
+def _descendants_csr(root, indptr, indices):
+    """ Iterative preorder walk of the subtree rooted at the index root over
+        CSR children arrays, returns the flat int array of the visited indexes.
+
+        >>> _descendants_csr(0, array('i', [0, 2, 3, 3, 3]), array('i', [1, 3, 2]))
+        array('i', [0, 1, 2, 3])
     """
-    >>> flatten([1 , [2, 2], [2, [3, 3, 3]]]) 
-    [1, 2, 2, 2, 3, 3, 3]
-    """ 
-    # flatten fonction from C:\Python26\Lib\compiler\ast.py, 
-    # compiler is deprecated in py2.6
-    l = []
-    for elt in seq:
-        t = type(elt)
-        if t is tuple or t is list or t is set:
-            for elt2 in flatten(elt):
-                l.append(elt2)
-        else:
-            l.append(elt)
-    return l
+    result = array('i')
+    append = result.append
+    stack = [root]
+    pop = stack.pop
+    push = stack.extend
+    while stack:
+        idx = pop()
+        append(idx)
+        start, end = indptr[idx], indptr[idx + 1]
+        if start != end:
+            push(indices[start:end][::-1])
+    return result
+
 
 class NcbiTaxonomyTree(object):
 
     def __init__(self, nodes_filename=None, names_filename=None):
-        """ Builds the following dictionnary from NCBI taxonomy nodes.dmp and 
-        names.dmp files :
-        { Taxid   : namedtuple('Node', ['name', 'rank', 'parent', 'children'] }
+        """ Builds the following parallel arrays from NCBI taxonomy nodes.dmp
+        and names.dmp files, indexed by a compact node index
+        (self.taxid2idx / self.idx2taxid) :
+            parent : index of the parent node, -1 for the root
+            rank : index of the rank in self.ranks
+            names + name_offset : the (utf-8 encoded) name of the node i is
+                names[name_offset[i]:name_offset[i+1]]
+            children_indptr + children_indices : children in CSR layout, the
+                children of the node i are
+                children_indices[children_indptr[i]:children_indptr[i+1]]
         https://www.biostars.org/p/13452/
         https://pythonhosted.org/ete2/tutorial/tutorial_ncbitaxonomy.html
         """
         self.standard_ranks = stdranks = ['species','genus','family','order','class','phylum','superkingdom']
+        # the results are immutable tuples of indexes shared between queries
+        self._leaves_cache = _LRUCache(maxsize=128)
+        self._lineage_cache = _LRUCache(maxsize=8192)
         if nodes_filename and names_filename:
             log.info("NcbiTaxonomyTree building ...")
-            Node = namedtuple('Node', ['name', 'rank', 'parent', 'children'])
-            taxid2name = {}
-            log.debug("names.dmp parsing ...")
-            with open(names_filename) as names_file:
-                for line in names_file:
-                    line = [elt for elt in line.split('|')]
-                    if line[3] == "\tscientific name\t":
-                        taxid = int(line[0])
-                        taxid2name[taxid] = line[1][1:-1]
-            log.debug("names.dmp parsed")
-
             log.debug("nodes.dmp parsing ...")
-            self.dic = {}
-            with open(nodes_filename) as nodes_file:
+            taxids = array('i')
+            parent_taxids = array('i')
+            # the ranks are mapped to their id as they are read, so only one
+            # string per distinct rank is kept
+            self.rank = array('h')
+            rank2idx = {}
+            # bound once, the columns are filled in place line after line
+            append_taxid = taxids.append
+            append_parent_taxid = parent_taxids.append
+            append_rank = self.rank.append
+            with open(nodes_filename, 'rb') as nodes_file:
                 for line in nodes_file:
-                    line = [elt for elt in line.split('|')][:3]
-                    taxid = int(line[0])
-                    parent_taxid = int(line[1])
-
-                    if taxid in self.dic: # 18204/1308852
-                        self.dic[taxid] = self.dic[taxid]._replace(rank=line[2][1:-1], parent=parent_taxid)
-                    else: # 1290648/1308852
-                        self.dic[taxid] = Node(name=taxid2name[taxid], rank=line[2][1:-1], parent=parent_taxid, children=[])
-                        del taxid2name[taxid]
-
-                    try: # 1290648/1308852
-                        self.dic[parent_taxid].children.append(taxid)
-                    except KeyError: # 18204/1308852
-                        self.dic[parent_taxid] = Node(name=taxid2name[parent_taxid], rank=None, parent=None, children=[taxid])
-                        del taxid2name[parent_taxid]
-
+                    line = line.split(b'\t|\t', 3)
+                    append_taxid(int(line[0]))
+                    append_parent_taxid(int(line[1]))
+                    append_rank(rank2idx.setdefault(line[2], len(rank2idx)))
             log.debug("nodes.dmp parsed")
+
+            n = len(taxids)
+            self.idx2taxid = taxids
+            self.taxid2idx = taxid2idx = dict(zip(taxids, range(n)))
+            self.parent = parent = array('i', map(taxid2idx.__getitem__, parent_taxids))
             # to avoid infinite loop
-            root_children = self.dic[1].children
-            root_children.remove(1)
-            self.dic[1] = self.dic[1]._replace(parent=None, children=root_children)
+            parent[taxid2idx[1]] = -1
+
+            self.ranks = [_decode(rank) for rank in sorted(rank2idx, key=rank2idx.get)]
+            # rank id bitmasks : bit i is set if the rank i is standard / is 'no rank'
+            self._std_rank_bits = sum(1 << i for i, rank in enumerate(self.ranks) if rank in stdranks)
+            self._no_rank_bit = sum(1 << i for i, rank in enumerate(self.ranks) if rank == 'no rank')
+            # inverted index : rank -> taxids at this rank, in file order
+            rank2taxids = [array('i') for rank in self.ranks]
+            for taxid, rank in zip(taxids, self.rank):
+                rank2taxids[rank].append(taxid)
+            self.rank2taxids = dict(zip(self.ranks, rank2taxids))
+
+            log.debug("names.dmp parsing ...")
+            # the names are written directly at their node index
+            names = [b''] * n
+            with open(names_filename, 'rb') as names_file:
+                for line in names_file:
+                    # only the 3 first fields are split off
+                    line = line.split(b'\t|\t', 3)
+                    if line[3].startswith(b'scientific name'):
+                        names[taxid2idx[int(line[0])]] = line[1]
+            log.debug("names.dmp parsed")
+            self.names = b''.join(names)
+            self.name_offset = name_offset = array('l', [0]) * (n + 1)
+            for i, name in enumerate(names):
+                name_offset[i + 1] = name_offset[i] + len(name)
+
+            self.children_indptr, self.children_indices = _children_csr(parent)
+
+            # preorder of the whole tree : the subtree of the node i is the
+            # slice preorder[preorder_pos[i]:preorder_pos[i] + subtree_size[i]]
+            self.preorder = preorder = _descendants_csr(taxid2idx[1], self.children_indptr, self.children_indices)
+            self.preorder_pos = preorder_pos = array('i', [0]) * n
+            for pos, idx in enumerate(preorder):
+                preorder_pos[idx] = pos
+            # in reverse preorder a node is met after all its descendants : the
+            # subtree sizes and leaf counts are summed up from the leaves
+            self.subtree_size = subtree_size = array('i', [1]) * n
+            indptr = self.children_indptr
+            self.subtree_leaves = subtree_leaves = array('i', [indptr[i] == indptr[i + 1] for i in range(n)])
+            for idx in reversed(preorder[1:]):
+                p = parent[idx]
+                subtree_size[p] += subtree_size[idx]
+                subtree_leaves[p] += subtree_leaves[idx]
+
+            # depth of each node, the root at 0, filled in preorder so that a
+            # parent is always set before its children
+            self.depth = depth = array('h', [0]) * n
+            for idx in preorder[1:]:
+                depth[idx] = depth[parent[idx]] + 1
             log.info("NcbiTaxonomyTree built")
 
+    # built arrays written by save(), taxid2idx is rebuilt from idx2taxid on load()
+    _saved_attributes = ('idx2taxid', 'parent', 'rank', 'ranks', 'names', 'name_offset',
+                         'children_indptr', 'children_indices', 'preorder', 'preorder_pos',
+                         'subtree_size', 'subtree_leaves', 'depth', 'rank2taxids',
+                         '_std_rank_bits', '_no_rank_bit')
+
+    def save(self, filename):
+        """ Saves the built tree in a binary file that NcbiTaxonomyTree.load
+            reads back much faster than parsing nodes.dmp and names.dmp again.
+
+            >>> tree = NcbiTaxonomyTree(nodes_filename="nodes.dmp", names_filename="names.dmp")
+            >>> tree.save("tree.pickle")
+            >>> loaded_tree = NcbiTaxonomyTree.load("tree.pickle")
+            >>> loaded_tree.getAscendantsWithRanksAndNames([562]) == tree.getAscendantsWithRanksAndNames([562])
+            True
+            >>> loaded_tree.getLeaves(561) == tree.getLeaves(561)
+            True
+            >>> os.remove("tree.pickle")
+        """
+        log.info("NcbiTaxonomyTree saving ...")
+        attributes = dict((name, getattr(self, name)) for name in self._saved_attributes)
+        with open(filename, 'wb') as tree_file:
+            pickle.dump(attributes, tree_file, pickle.HIGHEST_PROTOCOL)
+        log.info("NcbiTaxonomyTree saved")
+
+    @classmethod
+    def load(cls, filename):
+        """ Returns the tree saved in filename by NcbiTaxonomyTree.save.
+        """
+        log.info("NcbiTaxonomyTree loading ...")
+        tree = cls()
+        with open(filename, 'rb') as tree_file:
+            tree.__dict__.update(pickle.load(tree_file))
+        tree.taxid2idx = dict(zip(tree.idx2taxid, range(len(tree.idx2taxid))))
+        log.info("NcbiTaxonomyTree loaded")
+        return tree
+
+    def _name(self, idx):
+        return _decode(self.names[self.name_offset[idx]:self.name_offset[idx + 1]])
+
     def getParent(self, taxids):
         """
             >>> tree = NcbiTaxonomyTree(nodes_filename="nodes.dmp", names_filename="names.dmp")
             >>> tree.getParent([28384, 131567])
             {28384: 1, 131567: 1}
         """
+        taxid2idx = self.taxid2idx
+        parent = self.parent
+        idx2taxid = self.idx2taxid
         result = {}
         for taxid in taxids:
-            result[taxid] = self.dic[taxid].parent
+            idx = parent[taxid2idx[taxid]]
+            result[taxid] = idx2taxid[idx] if idx >= 0 else None
         return result
 
     def getRank(self, taxids):
@@ -97,9 +268,12 @@ class NcbiTaxonomyTree(object):
             >>> tree.getRank([28384, 131567])
             {28384: 'no rank', 131567: 'no rank'}
         """
+        taxid2idx = self.taxid2idx
+        rank = self.rank
+        ranks = self.ranks
         result = {}
         for taxid in taxids:
-            result[taxid] = self.dic[taxid].rank
+            result[taxid] = ranks[rank[taxid2idx[taxid]]]
         return result
 
     def getChildren(self, taxids):
@@ -108,9 +282,14 @@ class NcbiTaxonomyTree(object):
             >>> tree.getChildren([28384, 131567])
             {28384: [2387, 2673, 31896, 36549, 81077], 131567: [2, 2157, 2759]}
         """
+        taxid2idx = self.taxid2idx
+        indptr = self.children_indptr
+        indices = self.children_indices
+        idx2taxid = self.idx2taxid
         result = {}
         for taxid in taxids:
-            result[taxid] = self.dic[taxid].children
+            idx = taxid2idx[taxid]
+            result[taxid] = [idx2taxid[child] for child in indices[indptr[idx]:indptr[idx + 1]]]
         return result
 
     def getName(self, taxids):
@@ -119,9 +298,13 @@ class NcbiTaxonomyTree(object):
             >>> tree.getName([28384, 131567])
             {28384: 'other sequences', 131567: 'cellular organisms'}
         """
+        taxid2idx = self.taxid2idx
+        names = self.names
+        name_offset = self.name_offset
         result = {}
         for taxid in taxids:
-            result[taxid] = self.dic[taxid].name
+            idx = taxid2idx[taxid]
+            result[taxid] = _decode(names[name_offset[idx]:name_offset[idx + 1]])
         return result
 
 
@@ -147,28 +330,84 @@ class NcbiTaxonomyTree(object):
               Node(taxid=1236, rank='class', name='Gammaproteobacteria'),
               Node(taxid=1224, rank='phylum', name='Proteobacteria'),
               Node(taxid=2, rank='superkingdom', name='Bacteria')]}
+            >>> tree.getAscendantsWithRanksAndNames([1115515], only_std_ranks=True)[1115515][:2] # doctest: +NORMALIZE_WHITESPACE
+            [Node(taxid=1115515, rank='no rank', name='Escherichia vulneris NBRC 102420'),
+             Node(taxid=566, rank='species', name='Escherichia vulneris')]
         """
-        def _getAscendantsWithRanksAndNames(taxid, only_std_ranks):
-            Node = namedtuple('Node', ['taxid', 'rank', 'name'])
-            lineage = [Node(taxid=taxid, 
-                                rank=self.dic[taxid].rank, 
-                                name=self.dic[taxid].name)]
-            while self.dic[taxid].parent != None:
-                taxid = self.dic[taxid].parent
-                lineage.append(Node(taxid=taxid, 
-                                        rank=self.dic[taxid].rank, 
-                                        name=self.dic[taxid].name))
-            if only_std_ranks:
-                std_lineage = [lvl for lvl in lineage if lvl.rank in self.standard_ranks]
-                lastlevel = 0
-                if lineage[lastlevel].rank == 'no rank':
-                    std_lineage.insert(0, lineage[lastlevel])
-                lineage = std_lineage
-            return lineage
+        idxs = [self.taxid2idx[taxid] for taxid in taxids]
+        # bitmasks of the rank ids to keep (all of them if not only_std_ranks),
+        # the first level being also kept if it has no rank
+        rank_bits = self._std_rank_bits if only_std_ranks else -1
+        first_rank_bits = rank_bits | self._no_rank_bit
+        rank = self.rank
+        result = {}
+        for taxid, lineage in zip(taxids, self._lineages(idxs)):
+            # the std ranks filter and the Node construction in a single pass
+            result[taxid] = [Node(taxid=self.idx2taxid[idx], 
+                                rank=self.ranks[rank[idx]], 
+                                name=self._name(idx)) 
+                    for i, idx in enumerate(lineage)
+                    if (first_rank_bits if i == 0 else rank_bits) >> rank[idx] & 1]
+        return result
+
+    def _lineages(self, idxs):
+        """ Returns for each idx the tuple of its ascendant indexes (the idx
+            itself included, the root last). The lineages of all the nodes
+            met while climbing are memoized, so the climb stops at the first
+            ascendant already seen in this batch or a previous one.
+        """
+        parent = self.parent
+        cache = self._lineage_cache
+        lineages = []
+        for idx in idxs:
+            path = []
+            lineage = cache.get(idx)
+            while lineage is None:
+                path.append(idx)
+                idx = parent[idx]
+                lineage = cache.get(idx) if idx >= 0 else ()
+            for idx in reversed(path):
+                lineage = (idx,) + lineage
+                cache.put(idx, lineage)
+            lineages.append(lineage)
+        return lineages
+
+    def isAscendant(self, taxid, descendant):
+        """ Returns True if taxid is an ascendant of descendant (a node being
+            its own ascendant), i.e. if descendant falls in the preorder
+            interval of the subtree of taxid.
+
+            >>> tree = NcbiTaxonomyTree(nodes_filename="nodes.dmp", names_filename="names.dmp")
+            >>> tree.isAscendant(561, 562), tree.isAscendant(562, 561), tree.isAscendant(562, 562)
+            (True, False, True)
+        """
+        idx = self.taxid2idx[taxid]
+        start = self.preorder_pos[idx]
+        return start <= self.preorder_pos[self.taxid2idx[descendant]] < start + self.subtree_size[idx]
+
+    def getLowestCommonAncestors(self, taxid_pairs):
+        """ Returns the lowest common ancestor of each (taxid, taxid) pair :
+            the deepest node of the pair is first lifted to the depth of the
+            other one, then both climb in lockstep until they meet.
 
+            >>> tree = NcbiTaxonomyTree(nodes_filename="nodes.dmp", names_filename="names.dmp")
+            >>> pair2lca = tree.getLowestCommonAncestors([(562, 566), (562, 561), (562, 2157), (1, 562)])
+            >>> pair2lca == {(562, 566): 561, (562, 561): 561, (562, 2157): 131567, (1, 562): 1}
+            True
+        """
+        taxid2idx = self.taxid2idx
+        parent = self.parent
+        depth = self.depth
         result = {}
-        for taxid in taxids:
-            result[taxid] = _getAscendantsWithRanksAndNames(taxid, only_std_ranks)
+        for taxid1, taxid2 in taxid_pairs:
+            a, b = taxid2idx[taxid1], taxid2idx[taxid2]
+            for _ in range(depth[a] - depth[b]):
+                a = parent[a]
+            for _ in range(depth[b] - depth[a]):
+                b = parent[b]
+            while a != b:
+                a, b = parent[a], parent[b]
+            result[(taxid1, taxid2)] = self.idx2taxid[a]
         return result
 
     def _getDescendants(self, taxid):
@@ -177,12 +416,22 @@ class NcbiTaxonomyTree(object):
             >>> tree._getDescendants(208962) # doctest: +NORMALIZE_WHITESPACE
             [208962, 502347, 550692, 550693, 909209, 910238, 1115511, 1440052]
         """
-        children = self.dic[taxid].children
-        if children:
-            result = [ self._getDescendants(child) for child in children] 
-            result.insert(0, taxid)
-        else:
-            result = taxid
+        return [self.idx2taxid[idx] for idx in self._descendants(self.taxid2idx[taxid])]
+
+    def _descendants(self, idx):
+        """ Flat preorder array of the indexes of the subtree rooted at idx.
+        """
+        start = self.preorder_pos[idx]
+        return self.preorder[start:start + self.subtree_size[idx]]
+
+    def _leaves(self, idx):
+        """ Flat preorder tuple of the leaf indexes of the subtree rooted at idx.
+        """
+        result = self._leaves_cache.get(idx)
+        if result is None:
+            indptr = self.children_indptr
+            result = tuple(i for i in self._descendants(idx) if indptr[i] == indptr[i + 1])
+            self._leaves_cache.put(idx, result)
         return result
 
     def getDescendants(self, taxids): 
@@ -197,7 +446,7 @@ class NcbiTaxonomyTree(object):
         """
         result = {}
         for taxid in taxids:
-            result[taxid] = flatten(self._getDescendants(taxid))
+            result[taxid] = self._getDescendants(taxid)
         return result
 
     def getDescendantsWithRanksAndNames(self, taxids):
@@ -212,13 +461,28 @@ class NcbiTaxonomyTree(object):
             >>> taxid2descendants[566][1].name 
             'Escherichia vulneris NBRC 102420'
         """
-        Node = namedtuple('Node', ['taxid', 'rank', 'name'])
         result = {}
         for taxid in taxids:
-            result[taxid] = [Node(taxid=descendant, 
-                                rank=self.dic[descendant].rank, 
-                                name=self.dic[descendant].name) 
-                    for descendant in self._getDescendants(taxid)] 
+            result[taxid] = [Node(taxid=self.idx2taxid[idx], 
+                                rank=self.ranks[self.rank[idx]], 
+                                name=self._name(idx)) 
+                    for idx in self._descendants(self.taxid2idx[taxid])] 
+        return result
+
+    def countDescendants(self, taxids):
+        """ Returns the number of descendants (the taxid included) of each
+            taxid, i.e. len(getDescendants([taxid])[taxid]) without building
+            the list.
+
+            >>> tree = NcbiTaxonomyTree(nodes_filename="nodes.dmp", names_filename="names.dmp")
+            >>> tree.countDescendants([208962, 566]) == {566: 2, 208962: 8}
+            True
+        """
+        taxid2idx = self.taxid2idx
+        subtree_size = self.subtree_size
+        result = {}
+        for taxid in taxids:
+            result[taxid] = subtree_size[taxid2idx[taxid]]
         return result
 
     def getLeaves(self, taxid): 
@@ -232,18 +496,10 @@ class NcbiTaxonomyTree(object):
             >>> taxids_leaves_escherichia_genus = tree.getLeaves(561)
             >>> len(taxids_leaves_escherichia_genus)
             3382
+            >>> tree.getLeaves(1115515)
+            [1115515]
         """
-        def _getLeaves(taxid):
-            children = self.dic[taxid].children
-            result = [_getLeaves(child) for child in children] if children else taxid
-            return result
-        result = _getLeaves(taxid)
-
-        if not isinstance(result,Iterable): # In case of the taxid has no child
-            result = [result]
-        else:
-            result = flatten(result)
-        return result
+        return [self.idx2taxid[idx] for idx in self._leaves(self.taxid2idx[taxid])]
 
     def getLeavesWithRanksAndNames(self, taxid): 
         """ Returns all the descendant taxids that are leaves of the tree from 
@@ -254,11 +510,25 @@ class NcbiTaxonomyTree(object):
             >>> taxids_leaves_entire_tree[0]
             Node(taxid=1266749, rank='no rank', name='Escherichia coli B1C1')
         """
-        Node = namedtuple('Node', ['taxid', 'rank', 'name'])                            
-        result = [Node(taxid=leaf, 
-                        rank=self.dic[leaf].rank, 
-                        name=self.dic[leaf].name) 
-                    for leaf in self.getLeaves(taxid)] 
+        result = [Node(taxid=self.idx2taxid[idx], 
+                        rank=self.ranks[self.rank[idx]], 
+                        name=self._name(idx)) 
+                    for idx in self._leaves(self.taxid2idx[taxid])] 
+        return result
+
+    def countLeaves(self, taxids):
+        """ Returns the number of leaves of the subtree of each taxid, i.e.
+            len(getLeaves(taxid)) without building the list.
+
+            >>> tree = NcbiTaxonomyTree(nodes_filename="nodes.dmp", names_filename="names.dmp")
+            >>> tree.countLeaves([1, 561, 1115515]) == {1: 1184218, 561: 3382, 1115515: 1}
+            True
+        """
+        taxid2idx = self.taxid2idx
+        subtree_leaves = self.subtree_leaves
+        result = {}
+        for taxid in taxids:
+            result[taxid] = subtree_leaves[taxid2idx[taxid]]
         return result
 
     def getTaxidsAtRank(self, rank):
@@ -271,27 +541,50 @@ class NcbiTaxonomyTree(object):
             >>> tree = NcbiTaxonomyTree(nodes_filename="nodes.dmp", names_filename="names.dmp")
             >>> tree.getTaxidsAtRank('superkingdom')
             [2, 2157, 2759, 10239, 12884]
+            >>> tree.getTaxidsAtRank('unknown rank')
+            []
         """ 
-        return [taxid for taxid,node in self.dic.iteritems() if node.rank == rank]
+        return self.rank2taxids.get(rank, array('i')).tolist()
 
     def preorderTraversal(self, taxid, only_leaves):
         """ Prefix (Preorder) visit of the tree
             https://en.wikipedia.org/wiki/Tree_traversal
+
+            Returns the subtree as nested lists (children only) if only_leaves
+            else as nested (children, taxid) tuples, a leaf being its taxid.
+            The nesting is built directly during an iterative walk, one stack
+            frame per open internal node.
+
+            >>> tree = NcbiTaxonomyTree(nodes_filename="nodes.dmp", names_filename="names.dmp")
+            >>> tree.preorderTraversal(566, only_leaves=False)
+            ([1115515], 566)
+            >>> tree.preorderTraversal(566, only_leaves=True)
+            [1115515]
+            >>> tree.preorderTraversal(1115515, only_leaves=True)
+            1115515
         """
-        if only_leaves:
-            def _preorderTraversal(taxid):
-                children = self.dic[taxid].children
-                result = [_preorderTraversal(child) for child in children] if children else taxid
-                return result
-        else:
-            def _preorderTraversal(taxid):
-                children = self.dic[taxid].children
-                if children:
-                    result = ([_preorderTraversal(child) for child in children] , taxid )
+        indptr = self.children_indptr
+        indices = self.children_indices
+        idx2taxid = self.idx2taxid
+        idx = self.taxid2idx[taxid]
+        if indptr[idx] == indptr[idx + 1]:
+            return taxid
+        # frame : (node index, iterator over its remaining children, results of its children)
+        stack = [(idx, iter(indices[indptr[idx]:indptr[idx + 1]]), [])]
+        while True:
+            idx, children, results = stack[-1]
+            for child in children:
+                if indptr[child] == indptr[child + 1]:
+                    results.append(idx2taxid[child])
                 else:
-                    result = taxid
-                return result
-        return _preorderTraversal(taxid)
+                    stack.append((child, iter(indices[indptr[child]:indptr[child + 1]]), []))
+                    break
+            else:
+                stack.pop()
+                result = results if only_leaves else (results, idx2taxid[idx])
+                if not stack:
+                    return result
+                stack[-1][2].append(result)
      
 
 if __name__ == "__main__":